@@ -6,6 +6,10 @@ mkdir -p $TMP
 WILLIAMS=./tools/significance-williams/williams-sig.neg.sh
 WILLIAMS_SP=./tools/significance-williams/williams-sig.neg.spearman.sh
 
+# Bootstrap samples of the sentence level and their seed, fixed so that the stored results of different runs are paired
+BOOTSTRAP=1000
+RSEED=1
+
 
 
 for type in expected_wins trueskill ; do
@@ -13,7 +17,9 @@ for type in expected_wins trueskill ; do
     echo "--------------------------------------------------------------------------"
     echo "system-Level evaluation ($type)"
     echo "--------------------------------------------------------------------------"
-    python3 scripts/system_correlation.py --human scores/system_scores_humans/$type.txt.gz --metrics scores/system_scores_metrics/*.gz --tablefmt orgtbl 2>&1 | tee results/sys.$type.txt
+    # Samples of the human scores for the confidence intervals, if they were generated
+    SAMPLES=$(ls scores/system_scores_humans/samples/$type.*.gz 2>/dev/null)
+    python3 scripts/system_correlation.py --human scores/system_scores_humans/$type.txt.gz --metrics scores/system_scores_metrics/*.gz --samples $SAMPLES --tablefmt orgtbl --save-results results/sys.$type.db 2>&1 | tee results/sys.$type.txt
 
     echo -e "METRIC\tLP\tTESTSET\tSYSTEM\tSCORE" > $TMP/metrics.ranking.wmt.header.txt
     zcat scores/system_scores_metrics/*.gz >> $TMP/metrics.ranking.wmt.header.txt
@@ -40,13 +46,13 @@ echo ""
 echo "--------------------------------------------------------------------------"
 echo "Sentence-Level Evaluation (Expanded)"
 echo "--------------------------------------------------------------------------"
-python3 scripts/sentence_correlation.py --judgments scores/sentence_pairwiseranks_humans/expanded.csv.gz --metrics scores/sentence_scores_metrics/*.gz --tablefmt orgtbl | tee results/sent.expanded.txt
+python3 scripts/sentence_correlation.py --judgments scores/sentence_pairwiseranks_humans/expanded.csv.gz --metrics scores/sentence_scores_metrics/*.gz --bootstrap $BOOTSTRAP --rseed $RSEED --tablefmt orgtbl --save-results results/sent.expanded.db | tee results/sent.expanded.txt
 
 echo ""
 echo "--------------------------------------------------------------------------"
 echo "Sentence-Level Evaluation (Unexpanded)"
 echo "--------------------------------------------------------------------------"
-python3 scripts/sentence_correlation.py --judgments scores/sentence_pairwiseranks_humans/unexpanded.csv.gz --metrics scores/sentence_scores_metrics/*.gz --tablefmt orgtbl | tee results/sent.unexpanded.txt
+python3 scripts/sentence_correlation.py --judgments scores/sentence_pairwiseranks_humans/unexpanded.csv.gz --metrics scores/sentence_scores_metrics/*.gz --bootstrap $BOOTSTRAP --rseed $RSEED --tablefmt orgtbl --save-results results/sent.unexpanded.db | tee results/sent.unexpanded.txt
 echo "--------------------------------------------------------------------------"
 
 rm -r $TMP
@@ -0,0 +1,172 @@
+# Helpers shared by system_correlation.py, sentence_correlation.py and compare_results.py
+
+from collections import deque
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import glob
+import sqlite3
+import numpy as np
+
+# Use the faster ISA-L decompressor if it is installed
+try:
+    from isal import igzip as gzip_reader
+except ImportError:
+    gzip_reader = gzip
+
+chunk_size = 1 << 24 # bytes of decompressed data parsed at once
+
+def positive_int(text):
+    """ Argument type for positive integers such as the number of jobs """
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive number" % text)
+    return value
+
+class NumberOfFieldsNotExpectedException(Exception): pass
+
+def parse_chunk(chunk, columns):
+    """ Parses complete tab separated lines given as bytes into a list with an array for each
+    column. columns are the numpy dtypes of the columns, text columns have dtype bytes and
+    columns with dtype None are skipped. The fields are located in the whole chunk at once
+    and converted by numpy, not line by line """
+    # Empty lines are ignored
+    while b'\n\n' in chunk:
+        chunk = chunk.replace(b'\n\n', b'\n')
+    chunk = chunk.strip(b'\n')
+    if not chunk:
+        return [None if dtype is None else np.array([], dtype=dtype) for dtype in columns]
+
+    buffer = np.frombuffer(chunk, dtype=np.uint8)
+    tabs = buffer == ord('\t')
+    newlines = buffer == ord('\n')
+
+    # Offsets of the ends of the fields, a row for each line if every line has the same number of fields
+    ends = np.append(np.flatnonzero(tabs | newlines), len(buffer))
+    if len(ends) % len(columns) == 0:
+        ends = ends.reshape(-1, len(columns))
+    if ends.ndim == 1 or tabs[ends[:-1, -1]].any() or not tabs[ends[:, :-1]].all():
+        line_ends = np.append(np.flatnonzero(newlines), len(buffer))
+        fields_counts = np.diff(np.searchsorted(np.flatnonzero(tabs), line_ends), prepend=0) + 1
+        wrong = fields_counts[fields_counts != len(columns)]
+        raise NumberOfFieldsNotExpectedException("Got %s fields" % wrong[0])
+    starts = np.empty_like(ends)
+    starts[:, 1:] = ends[:, :-1] + 1
+    starts[0, 0] = 0
+    starts[1:, 0] = ends[:-1, -1] + 1
+    widths = ends - starts
+    # Padded so that all fields can be read with the width of the longest field
+    buffer = np.append(buffer, np.zeros(max(int(widths.max()), 1), dtype=np.uint8))
+
+    arrays = []
+    for index, dtype in enumerate(columns):
+        if dtype is None:
+            arrays.append(None)
+            continue
+        # The bytes of the column's fields are copied to rows of a fixed width, padded by zeros
+        width = max(int(widths[:, index].max()), 1)
+        offsets = starts[:, index, None] + np.arange(width)
+        chars = np.where(offsets < ends[:, index, None], buffer[offsets], 0).astype(np.uint8)
+        fields = chars.view("S%d" % width).ravel()
+        arrays.append(fields if dtype is bytes else fields.astype(dtype))
+    return arrays
+
+def read_columns(file, columns):
+    """ Decompresses the tab separated file and returns a list with an array for each of
+    its columns (see parse_chunk). The data are parsed in large chunks """
+    parsed = []
+    rest = b''
+    try:
+        with gzip_reader.open(file, mode="rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                chunk = rest + chunk
+                end = chunk.rfind(b'\n') + 1
+                rest = chunk[end:]
+                parsed.append(parse_chunk(chunk[:end], columns))
+        parsed.append(parse_chunk(rest, columns))
+    except NumberOfFieldsNotExpectedException as e:
+        raise NumberOfFieldsNotExpectedException("%s in file %s" % (e, file))
+    return [None if dtype is None else np.concatenate(arrays) for dtype, arrays in zip(columns, zip(*parsed))]
+
+def read_files(file_likes, columns, jobs):
+    """ Yields (file, columns) for all files matching the given glob patterns, in order, where
+    columns are the arrays returned by read_columns. Up to jobs files are decompressed and
+    parsed concurrently """
+    files = [file for file_like in file_likes for file in glob.glob(file_like)]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for file in files:
+            pending.append((file, executor.submit(read_columns, file, columns)))
+            if len(pending) > jobs:
+                file, future = pending.popleft()
+                yield file, future.result()
+        while pending:
+            file, future = pending.popleft()
+            yield file, future.result()
+
+def run_starts(*columns):
+    """ Returns offsets of the first rows of the runs of rows with the same values in all columns """
+    if not len(columns[0]):
+        return np.array([], dtype=np.int64)
+    change = np.zeros(len(columns[0]), dtype=bool)
+    change[0] = True
+    for column in columns:
+        change[1:] |= column[1:] != column[:-1]
+    return np.flatnonzero(change)
+
+class Interner(dict):
+    """ Maps names (of systems or segments) to consecutive integer ids """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.names = []
+
+    def intern(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            self[name] = len(self.names)
+            self.names.append(name)
+            return self[name]
+
+    def intern_all(self, names):
+        """ Returns an array with ids of all given names """
+        unique, inverse = np.unique(names, return_inverse=True)
+        return np.array([self.intern(name.item()) for name in unique], dtype=np.int64)[inverse]
+
+def write_results(file, info, rows):
+    """ Writes results to SQLite database (replacing its content). The rows are tuples
+    (metric, direction, measure, value, lower, upper, fingerprint, samples) where samples
+    are values of the measure on the bootstrap samples stored as float64 array """
+    with sqlite3.connect(file) as db:
+        db.execute("DROP TABLE IF EXISTS info")
+        db.execute("DROP TABLE IF EXISTS results")
+        db.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)")
+        db.execute("""CREATE TABLE results (metric TEXT, direction TEXT, measure TEXT, value REAL,
+                lower REAL, upper REAL, fingerprint TEXT, samples BLOB, PRIMARY KEY (metric, direction, measure))""")
+        db.executemany("INSERT INTO info VALUES (?, ?)", sorted(info.items()))
+        db.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    db.close()
+
+class ResultsDatabase(object):
+    """ Results stored by write_results. The values and the fingerprints are read at once,
+    the bootstrap samples only when they are needed. """
+
+    def __init__(self, file):
+        self.db = sqlite3.connect(file)
+        self.info = dict(self.db.execute("SELECT key, value FROM info"))
+        self.results = {
+                (metric, direction, measure): (value, lower, upper, fingerprint)
+                for metric, direction, measure, value, lower, upper, fingerprint in self.db.execute(
+                    "SELECT metric, direction, measure, value, lower, upper, fingerprint FROM results")
+            }
+
+    def samples(self, key):
+        row = self.db.execute(
+                "SELECT samples FROM results WHERE metric = ? AND direction = ? AND measure = ?", key).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float64)
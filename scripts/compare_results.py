@@ -0,0 +1,163 @@
+#!/usr/bin/env python3.4
+
+# Compares results saved by system_correlation.py or sentence_correlation.py (--save-results)
+
+import argparse
+import sys
+import numpy as np
+from tabulate import tabulate
+from common import ResultsDatabase
+
+def parse_args():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+            description="""This script compares correlations of a new run with a baseline run, both
+            stored by --save-results. Only the metrics whose scores changed are compared, with a paired
+            bootstrap test when both runs used the same human judgments and bootstrap samples.
+            If the human judgments differ, all metrics are compared and the exit status is 2.
+            Otherwise the exit status is 1 if some metric got significantly worse.
+            """)
+
+    parser.add_argument("--baseline",
+            help="results database of the baseline run",
+            required=True,
+            metavar="FILE",
+            )
+
+    parser.add_argument("--run",
+            help="results database of the new run",
+            required=True,
+            metavar="FILE",
+            )
+
+    parser.add_argument("--alpha",
+            help="Significance level of the test (default 0.05)",
+            metavar="P",
+            default=0.05,
+            type=float,
+            )
+
+    parser.add_argument("--all",
+            help="Compare all metrics, not only those whose scores changed",
+            action='store_true',
+            )
+
+    parser.add_argument("--tablefmt",
+            help="Output table format (used by tabulate package)",
+            default="plain",
+            choices=["plain","simple","grid","pipe","orgtbl","rst","mediawiki","latex"]
+            )
+
+    return parser.parse_args()
+
+config = parse_args()
+
+def main():
+    baseline = ResultsDatabase(config.baseline)
+    run = ResultsDatabase(config.run)
+
+    if baseline.info.get("level") != run.info.get("level"):
+        print("Error: cannot compare %s level results with %s level results" % (baseline.info.get("level"), run.info.get("level")), file=sys.stderr)
+        sys.exit(2)
+
+    # Metrics with unchanged scores are skipped only if the runs used the same human judgments
+    # and bootstrap samples, the bootstrap samples are paired only if they were generated the same way
+    same_data = baseline.info == run.info
+    paired = same_data and baseline.info.get("bootstrap", "0") != "0"
+    if not paired:
+        print("Warning: the runs do not share bootstrap samples, significance is not tested", file=sys.stderr)
+
+    comparison_table = ComparisonTable(baseline, run, same_data, paired)
+    print(comparison_table.tabulate())
+
+    if baseline.info.get("human") != run.info.get("human"):
+        print("Error: the runs used different human judgments, all metrics were compared", file=sys.stderr)
+        sys.exit(2)
+
+    if comparison_table.regressions():
+        sys.exit(1)
+
+class ComparisonTable(object):
+    def __init__(self, baseline, run, same_data, paired):
+        self.rows = []
+        for key in sorted(set(baseline.results) | set(run.results)):
+            if key not in run.results:
+                self.rows.append(ComparisonRow(key, baseline.results[key][0], None, None, "removed"))
+                continue
+            if key not in baseline.results:
+                self.rows.append(ComparisonRow(key, None, run.results[key][0], None, "added"))
+                continue
+
+            base_value, base_fingerprint = baseline.results[key][0], baseline.results[key][3]
+            run_value, run_fingerprint = run.results[key][0], run.results[key][3]
+            if same_data and base_fingerprint == run_fingerprint and not config.all:
+                continue
+
+            p_value = None
+            status = "changed"
+            if paired:
+                base_samples = baseline.samples(key)
+                run_samples = run.samples(key)
+                if base_samples is not None and run_samples is not None and len(base_samples) == len(run_samples):
+                    p_value, status = paired_test(base_value, run_value, base_samples, run_samples, config.alpha)
+            self.rows.append(ComparisonRow(key, base_value, run_value, p_value, status))
+
+    def regressions(self):
+        return [row for row in self.rows if row.status == "worse"]
+
+    def header(self):
+        header_list = ["Metric", "Direction", "Measure", "Baseline", "Run", "Difference", "p-value", "Status"]
+        if config.tablefmt == "latex":
+            return ["\\textbf{%s}" % header for header in header_list]
+        else:
+            return header_list
+
+    def tabulate(self):
+        return tabulate(
+            self.rows,
+            headers=self.header(),
+            tablefmt=config.tablefmt,
+            floatfmt='.3f',
+            missingval='n/a',
+            numalign='left',
+        )
+
+class ComparisonRow(object):
+    def __init__(self, key, baseline, run, p_value, status):
+        self.metric, self.direction, self.measure = key
+        self.baseline = baseline
+        self.run = run
+        self.p_value = p_value
+        self.status = status
+
+    def __iter__(self):
+        yield self.metric
+        yield self.direction
+        yield self.measure
+        yield self.baseline
+        yield self.run
+        if self.baseline is not None and self.run is not None:
+            yield self.run - self.baseline
+        else:
+            yield None
+        yield self.p_value
+        yield self.status
+
+def paired_test(base_value, run_value, base_samples, run_samples, alpha):
+    """ Paired bootstrap test of the difference of the run and the baseline. The samples of both
+    runs come from the same resampled human judgments, the p-value is the fraction of the samples
+    where the difference does not have the same sign as the observed one. """
+    differences = run_samples - base_samples
+    if run_value > base_value:
+        p_value = np.mean(differences <= 0)
+        status = "better" if p_value < alpha else "not significant"
+    elif run_value < base_value:
+        p_value = np.mean(differences >= 0)
+        status = "worse" if p_value < alpha else "not significant"
+    else:
+        p_value = 1.0
+        status = "same"
+    return p_value, status
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,6 @@
 # Adapted from WMT 2015 metrics task script.
 
 from collections import defaultdict
-from collections import namedtuple
-import gzip
 import glob
 import csv
 import argparse
@@ -12,7 +10,14 @@ import sys
 import math
 import random
 import time
+import queue
+import threading
+import hashlib
+from statistics import NormalDist
+import os
 from tabulate import tabulate
+from common import gzip_reader, read_files, run_starts, Interner, write_results, positive_int
+import numpy as np
 
 alpha = 0.05
 
@@ -91,69 +96,496 @@ def parse_args():
             choices=["plain","simple","grid","pipe","orgtbl","rst","mediawiki","latex"]
             )
 
-    return parser.parse_args()
+    parser.add_argument("--jobs",
+            help="Number of files decompressed in parallel (default is the number of CPUs)",
+            metavar="N",
+            default=os.cpu_count() or 1,
+            type=positive_int,
+            )
+
+    parser.add_argument("--significance",
+            help="Performs a paired significance test between all pairs of metrics and prints a"
+                 " matrix of p-values of the row metric not being better than the column metric",
+            default=None,
+            choices=["bootstrap","permutation"]
+            )
+
+    parser.add_argument("--replicates",
+            help="Number of bootstrap samples or permutations used by --significance",
+            metavar="N",
+            default=1000,
+            type=positive_int,
+            )
+
+    parser.add_argument("--dtype",
+            help="Floating point type used to store the metric scores",
+            default="float64",
+            choices=["float32","float64"]
+            )
+
+    parser.add_argument("--save-results",
+            help="Store the correlations, confidence intervals and bootstrap samples of all metrics"
+                 " and variants to SQLite database FILE (runs are compared by compare_results.py)",
+            metavar="FILE",
+            default=None,
+            dest='results_file',
+            )
+
+    parser.add_argument("--follow",
+            help="Keep reading new human judgments (uncompressed CSV lines in the format of --judgments)"
+                 " from FILE, type '-' for stdin, and print updated correlations after each batch."
+                 " The confidence intervals are approximate (normal approximation)",
+            metavar="FILE",
+            default=None,
+            )
+
+    parser.add_argument("--batch-size",
+            help="Number of judgments read before the correlations are updated (default 1000)",
+            metavar="N",
+            default=1000,
+            type=positive_int,
+            dest='batch_size',
+            )
+
+    parser.add_argument("--interval",
+            help="Seconds to wait for new judgments before the correlations of an incomplete batch"
+                 " are printed (default 1)",
+            metavar="SEC",
+            default=1.0,
+            type=float,
+            )
+
+    parser.add_argument("--slice",
+            help="Break the correlations down into subsets of human comparisons: by the given"
+                 " segment ranges, by source sentence length (needs --src), by error type"
+                 " (needs --m2) or by pair of systems",
+            default=None,
+            choices=["range","length","errtype","syspair"]
+            )
+
+    parser.add_argument("--segments",
+            help="segment range(s) such as 0-99, only comparisons of these segments are used."
+                 " With '--slice range' each range is reported separately",
+            metavar="RANGE",
+            nargs='+',
+            default=None,
+            )
+
+    parser.add_argument("--src",
+            help="tokenized source sentences, one segment per line (for '--slice length')",
+            metavar="FILE",
+            default=None,
+            )
+
+    parser.add_argument("--length-buckets",
+            help="comma separated upper bounds of the sentence length buckets",
+            metavar="N,N,...",
+            default="10,20,30,40",
+            dest='length_buckets',
+            )
+
+    parser.add_argument("--m2",
+            help="M2 file with gold annotations, one sentence per segment (for '--slice errtype')",
+            metavar="FILE",
+            default=None,
+            )
+
+    args = parser.parse_args()
+    if args.slice == "range" and not args.segments:
+        parser.error("--slice range requires --segments")
+    if args.slice == "length" and not args.src:
+        parser.error("--slice length requires --src")
+    if args.slice == "errtype" and not args.m2:
+        parser.error("--slice errtype requires --m2")
+    return args
 config = parse_args()
 
 def main():
     # Load data
     data = SegmentLevelData()
-    for file in config.metrics:
-        data.add_metrics_data(file)
+    data.add_metrics_data(*config.metrics)
     data.add_human_data(config.judgments)
 
     # Compute results
+    if config.follow:
+        # Without given directions, all directions in the judgments are followed
+        streaming = StreamingTaus(data, config.directions or list(data.human_comparisons), not config.directions)
+        follow_judgments(streaming, config.follow)
+        return
+
     if not config.directions:
         config.directions = [k for k, v in data.human_comparisons.items()]
+
+    if config.slice:
+        for direction in config.directions:
+            slice_table = SliceTable(data, direction, config.variant, make_slices(data, direction))
+            print(direction)
+            print(slice_table.tabulate())
+            print()
+        return
+
     result_table = ResultTable(data, config.directions)
 
 
     print(result_table.tabulate())
 
-class MetricLanguagePairData(defaultdict):
-    """ Stores metric scores for given metric and for given language direction.
-    The keys of this dictionary like object are names of system and values are
-    dictionaries mapping from segment to score """
+    if config.results_file:
+        save_results(data, config.directions, config.results_file)
 
-    def __init__(self):
+    if config.significance:
+        for direction in config.directions:
+            significance_table = SignificanceTable(data, direction, config.variant, config.significance, config.replicates)
+            print()
+            print("%s %s test (%s)" % (direction, config.significance, config.variant))
+            print(significance_table.tabulate())
 
-        # values are dictionaries mapping segment number to actual metric score
-        # The underlying dictionary is indexed by system name and its
-        defaultdict.__init__(self, dict)
+judgment_fields = ["srclang", "trglang", "srcIndex", "segmentId", "judgeID", "system1Id", "system1rank", "system2Id", "system2rank", "rankingID"]
 
-    def kendall_tau(self, human_comparisons, variant='wmt14'):
+def follow_judgments(streaming, file):
+    """ Reads new human judgments from the file (like tail -f) or stdin in batches
+    and prints the updated correlations after each batch """
+    batches = stdin_batches() if file == '-' else file_batches(file)
+    try:
+        for batch in batches:
+            streaming.add_lines(batch)
+            print(time.strftime("%Y-%m-%d %H:%M:%S"), streaming.status())
+            print(StreamingTable(streaming).tabulate())
+            print(flush=True)
+    except KeyboardInterrupt:
+        pass
+
+def file_batches(file):
+    """ Yields batches of the lines appended to the file. A batch ends after --batch-size
+    lines or at the current end of the file """
+    with open(file, encoding="utf-8") as f:
+        # Only the judgments appended from now on are new
+        f.seek(0, os.SEEK_END)
+
+        batch = []
+        partial = ''
+        while True:
+            line = f.readline()
+            if line.endswith('\n'):
+                batch.append(partial + line)
+                partial = ''
+                if len(batch) < config.batch_size:
+                    continue
+            else:
+                # End of the file for now, the last line may be still incomplete
+                partial += line
+
+            if batch:
+                yield batch
+                batch = []
+            else:
+                time.sleep(config.interval)
+
+def stdin_batches():
+    """ Yields batches of the lines of stdin. A batch ends after --batch-size lines, when no
+    line comes for --interval seconds or at the end of the input. Stdin is read by another
+    thread, as reading a line blocks until the whole line comes """
+    lines = queue.Queue()
+
+    def queue_lines():
+        for line in sys.stdin:
+            lines.put(line)
+        lines.put(None)
 
+    threading.Thread(target=queue_lines, daemon=True).start()
+
+    batch = []
+    while True:
         try:
-            coeff_table = variants_definitions[variant]
-        except KeyError:
-            raise ValueError("There is no definition for %s variant" % variant)
-
-        numerator = 0
-        denominator = 0
-
-        # Iterate all human comparisons
-        for segment, sys1, sys2, human_comparison in human_comparisons:
-
-            sys1_metric_score = self[sys1].get(segment, None)
-            sys2_metric_score = self[sys2].get(segment, None)
-            #print(sys1_metric_score, sys1_metric_score, human_comparison)
-            #print(self[sys1].get(segment,None),self[sys2].get(segment,None))
-            if(sys1_metric_score is None or sys2_metric_score is None):
-                return None
-
-            # Get the metric comparison
-            # (here the relation '<' means "is better then")
-            compare = lambda x, y: '<' if x > y else '>' if x < y else '='
-            metric_comparison = compare(sys1_metric_score, sys2_metric_score)
-
-            # Adjust the numerator and denominator according the table with coefficients
-            coeff = coeff_table[human_comparison][metric_comparison]
+            line = lines.get(timeout=config.interval)
+        except queue.Empty:
+            line = ''
+
+        if line:
+            batch.append(line)
+            if len(batch) < config.batch_size:
+                continue
+
+        if batch:
+            yield batch
+            batch = []
+        if line is None:
+            return
+
+def parse_judgment(line):
+    """ Returns the language direction and the comparison (segment, system1, system2, relation)
+    of one line of human judgments given as a dictionary of the CSV fields """
+    def find_lang(code):
+        langdict = {'cze':'cs', 'eng':'en', 'fre':'fr', 'ces':'cs', 'deu':'de', 'fin':'fi', 'ron':'ro', 'rus':'ru', 'tur':'tr'}
+        if code in langdict:
+            return langdict[code]
+        else:
+            return code
+
+    #direction = line['system1Id'].rsplit('.', 2)[1]
+    direction = find_lang(line['srclang']) + '-' + find_lang(line['trglang'])
+    segment = int(line['segmentId'])
+
+    extract_system = lambda x: '.'.join(x.split('.')[1:-1])
+
+    id1 = extract_system(line['system1Id'])
+    rank1 = int(line['system1rank'])
+    id2 = extract_system(line['system2Id'])
+    rank2 = int(line['system2rank'])
+
+    # The extracted relation '<' means "is better than"
+    compare = lambda x, y: '<' if x < y else '>' if x > y else '='
+    return direction, (segment, id1, id2, compare(rank1, rank2))
+
+def save_results(data, directions, file):
+    """ Stores results of all metrics, directions and variants to SQLite database """
+    rows = []
+    for metric in sorted(data.metrics()):
+        for direction in directions:
+            if (metric, direction) not in data.metrics_data:
+                continue
+            fingerprint = data.metrics_data[metric, direction].fingerprint()
+            for variant in sorted(variants_definitions):
+                tau, confidence = data.compute_tau_confidence(metric, direction, variant)
+                if tau is None:
+                    continue
+                taus = data.tau_results[metric, direction, variant][1]
+                lower, upper = data.confidence_interval(taus)
+                samples = None if taus is None else np.array(taus, dtype=np.float64).tobytes()
+                rows.append((metric, direction, variant, float(tau), lower, upper, fingerprint, samples))
+
+    info = {
+            "level": "sentence",
+            "human": data.fingerprint(directions),
+            "bootstrap": str(config.bootstrap),
+        }
+    # The seed matters only when bootstrapping
+    if config.bootstrap:
+        info["rseed"] = str(config.rseed)
+    write_results(file, info, rows)
+
+def parse_range(text):
+    """ Parses a segment range such as '10-99' (inclusive) or a single segment '10' """
+    first, _, last = text.partition('-')
+    return range(int(first), int(last or first) + 1)
+
+def load_sentence_lengths(file):
+    """ Returns a list with the number of tokens of each source sentence """
+    with open(file, encoding="utf-8") as f:
+        return [len(line.split()) for line in f]
+
+def load_error_types(file):
+    """ Returns a dictionary mapping each error type of the M2 file to the set of
+    segments (sentence numbers) annotated with that error type """
+    error_types = defaultdict(set)
+    segment = -1
+    with open(file, encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("S "):
+                segment += 1
+            elif line.startswith("A "):
+                error_type = line.split("|||")[1]
+                if error_type != "noop":
+                    error_types[error_type].add(segment)
+    return error_types
+
+def make_slices(data, direction):
+    """ Returns a list of (name, segments, system_pairs) tuples describing the subsets
+    of human comparisons requested on the command line. A value of None means no restriction. """
+
+    segments = None
+    if config.segments:
+        segments = set(segment for text in config.segments for segment in parse_range(text))
+
+    restrict = lambda subset: subset if segments is None else subset & segments
+
+    if config.slice == "range":
+        return [(text, set(parse_range(text)), None) for text in config.segments]
+
+    if config.slice == "length":
+        bounds = [int(bound) for bound in config.length_buckets.split(',')]
+        lowers = [1] + [bound + 1 for bound in bounds]
+        names = ["%d-%d" % (lower, bound) for lower, bound in zip(lowers, bounds)] + ["%d+" % lowers[-1]]
+        buckets = [set() for _ in names]
+        for segment, length in enumerate(load_sentence_lengths(config.src)):
+            bucket = sum(1 for bound in bounds if length > bound)
+            buckets[bucket].add(segment)
+        return [(name, restrict(subset), None) for name, subset in zip(names, buckets)]
+
+    if config.slice == "errtype":
+        error_types = load_error_types(config.m2)
+        return [(name, restrict(error_types[name]), None) for name in sorted(error_types)]
+
+    if config.slice == "syspair":
+        systems = sorted(data.direction_systems[direction])
+        return [
+                ("%s vs %s" % (sys1, sys2), segments, set([frozenset((sys1, sys2))]))
+                for idx1, sys1 in enumerate(systems)
+                for idx2, sys2 in enumerate(systems)
+                if idx1 < idx2
+            ]
+
+    raise ValueError("Unknown slice %s" % config.slice)
+
+relation_codes = {'<': 0, '=': 1, '>': 2}
+
+def coefficient_tables(variant):
+    """ Returns the variant's coefficients as numerator and denominator tables
+    indexed by the relation codes of the human and the metric comparisons """
+    try:
+        coeff_table = variants_definitions[variant]
+    except KeyError:
+        raise ValueError("There is no definition for %s variant" % variant)
+
+    numerators = np.zeros((3, 3))
+    denominators = np.zeros((3, 3))
+    for human, human_code in relation_codes.items():
+        for metric, metric_code in relation_codes.items():
+            coeff = coeff_table[human][metric]
             if coeff != 'X':
-                numerator += coeff
-                denominator += 1
-        # Return the Kendall's tau
-        if denominator == 0:
-            return 1
-        return numerator / denominator
+                numerators[human_code, metric_code] = coeff
+                denominators[human_code, metric_code] = 1
+    return numerators, denominators
+
+def kendall_tau(human, relations, variant):
+    """ Computes Kendall's tau from arrays of relation codes of human and metric comparisons,
+    returns None if no comparison counts """
+    numerators, denominators = coefficient_tables(variant)
+    denominator = denominators[human, relations].sum()
+    if denominator == 0:
+        return None
+    return numerators[human, relations].sum() / denominator
+
+class MetricLanguagePairData(object):
+    """ Stores metric scores for given metric and for given language direction in a dense
+    systems x segments array. Systems and segments are mapped to rows and columns by
+    interners shared by all metrics of the direction, a bitmap marks the scores present.
+    """
+
+    def __init__(self, system_ids, segment_ids, dtype=np.float64):
+        self.system_ids = system_ids
+        self.segment_ids = segment_ids
+        self.scores = np.zeros((0, 0), dtype=dtype)
+        self.present = np.zeros((0, 0), dtype=np.uint8) # one bit per segment
+
+    def reserve(self, systems, segments):
+        """ Grows the arrays (at least twice) to hold given number of systems and segments """
+        old_systems, old_segments = self.scores.shape
+        if systems <= old_systems and segments <= old_segments:
+            return
+        if systems > old_systems:
+            systems = max(systems, 2 * old_systems)
+        if segments > old_segments:
+            segments = max(segments, 2 * old_segments)
+        systems = max(systems, old_systems)
+        segments = max(segments, old_segments)
+
+        scores = np.zeros((systems, segments), dtype=self.scores.dtype)
+        scores[:old_systems, :old_segments] = self.scores
+        present = np.zeros((systems, (segments + 7) // 8), dtype=np.uint8)
+        present[:old_systems, :self.present.shape[1]] = self.present
+        self.scores = scores
+        self.present = present
+
+    def is_present(self, systems, segments):
+        """ Returns boolean array telling which of the (system id, segment id) scores are present,
+        negative ids (unknown systems or segments) are never present """
+        known = (systems >= 0) & (segments >= 0) & (systems < self.scores.shape[0]) & (segments < self.scores.shape[1])
+        result = np.zeros(len(systems), dtype=bool)
+        bits = self.present[systems[known], segments[known] >> 3] >> (segments[known] & 7)
+        result[known] = (bits & 1).astype(bool)
+        return result
+
+    def add(self, systems, segments, scores):
+        """ Stores scores for given arrays of system and segment ids. Scores already present are
+        kept, the positions of the duplicates (in given arrays) are returned """
+        if len(systems) == 0:
+            return np.zeros(0, dtype=np.int64)
+        self.reserve(systems.max() + 1, segments.max() + 1)
+
+        # The first occurrence in the batch is stored unless the score is already present
+        keys = systems * self.scores.shape[1] + segments
+        _, first = np.unique(keys, return_index=True)
+        new = np.zeros(len(keys), dtype=bool)
+        new[first] = True
+        new &= ~self.is_present(systems, segments)
+
+        self.scores[systems[new], segments[new]] = scores[new]
+        np.bitwise_or.at(self.present, (systems[new], segments[new] >> 3), (1 << (segments[new] & 7)).astype(np.uint8))
+        return np.flatnonzero(~new)
+
+    def fingerprint(self):
+        """ Returns a hash of the stored (system name, segment number, score) triples in sorted order.
+        It does not depend on the ids, which depend on the order of loading and on the other metrics """
+        systems = min(len(self.system_ids.names), self.scores.shape[0])
+        segments = min(len(self.segment_ids.names), self.scores.shape[1])
+        present = np.unpackbits(self.present, axis=1, bitorder='little')[:systems, :segments].astype(bool)
+
+        numbers = np.array(self.segment_ids.names[:segments], dtype=np.int64)
+        columns = np.argsort(numbers, kind='stable')
+        numbers = numbers[columns]
+
+        digest = hashlib.sha1()
+        for row in sorted(range(systems), key=lambda system_id: self.system_ids.names[system_id]):
+            mask = present[row, columns]
+            if not mask.any():
+                continue
+            digest.update(self.system_ids.names[row].encode("utf-8") + b'\0')
+            digest.update(numbers[mask].tobytes())
+            digest.update(self.scores[row, columns][mask].astype(np.float64).tobytes())
+        return digest.hexdigest()
+
+    def relations(self, systems1, systems2, segments):
+        """ Returns relation codes of the metric comparisons of the first and the second system
+        (arrays of ids) on given segments (here the relation '<' means "is better then"), or None
+        if some segment score is missing """
+        if not (self.is_present(systems1, segments).all() and self.is_present(systems2, segments).all()):
+            return None
+        scores1 = self.scores[systems1, segments]
+        scores2 = self.scores[systems2, segments]
+        relations = np.full(len(segments), relation_codes['='], dtype=np.int8)
+        relations[scores1 > scores2] = relation_codes['<']
+        relations[scores1 < scores2] = relation_codes['>']
+        return relations
+
+class ComparisonIndex(object):
+    """ Index over the human comparisons of one language direction. The positions of
+    the comparisons are kept ordered by segment together with the offsets of each segment
+    and of each pair of systems, so the comparisons of any subset of segments or pairs
+    are found without scanning all of them.
+    """
+
+    def __init__(self, comparisons):
+        self.comparisons = comparisons
+        self.positions = sorted(range(len(comparisons)), key=lambda position: comparisons[position][0])
+
+        # Maps segment to (start, end) offsets into the list of positions
+        self.offsets = {}
+        # Maps unordered pair of systems to the list of offsets of its comparisons
+        self.pair_offsets = defaultdict(list)
+        for offset, position in enumerate(self.positions):
+            segment = comparisons[position][0]
+            start, _ = self.offsets.get(segment, (offset, offset))
+            self.offsets[segment] = (start, offset + 1)
+            self.pair_offsets[frozenset(comparisons[position][1:3])].append(offset)
+
+    def select(self, segments=None, system_pairs=None):
+        """ Returns positions of the comparisons of given segments between given pairs of systems.
+        The system pairs are given as frozensets, None stands for all segments or all pairs """
+        if system_pairs is not None:
+            offsets = sorted(offset for pair in system_pairs for offset in self.pair_offsets.get(pair, []))
+            if segments is not None:
+                offsets = [offset for offset in offsets if self.comparisons[self.positions[offset]][0] in segments]
+            return [self.positions[offset] for offset in offsets]
+
+        if segments is None:
+            return list(self.positions)
+
+        selected = []
+        for segment in sorted(segments):
+            if segment in self.offsets:
+                start, end = self.offsets[segment]
+                selected.extend(self.positions[start:end])
+        return selected
 
 class SegmentLevelData(object):
     """ Stores scores for all metrics, language directions and systems. Also stores human scores
@@ -161,22 +593,55 @@ class SegmentLevelData(object):
     """
 
     def __init__(self):
-        self.metrics_data = defaultdict(MetricLanguagePairData) # indexed by tuples (metric, direction)
+        self.metrics_data = {} # indexed by tuples (metric, direction)
         self.human_comparisons = defaultdict(list) # indexed by language direction
         self.direction_systems = defaultdict(set) # indexed by language directions
-
-    def add_metrics_data(self, file_like):
-        for file in glob.glob(file_like):
-            with gzip.open(file, mode="rt") as f:
-                for metric, lang_pair, test_set, system, segment, score in csv.reader(f, delimiter='\t'):
-                    # Convert numerical values
-                    segment = int(segment)
-                    score = float(score)
-                    if segment not in self.metrics_data[metric, lang_pair][system]:
-                        self.metrics_data[metric, lang_pair][system][segment] = score
-                    else:
-                        print("Warning: ", metric, lang_pair, system, segment, "Segment score already exists." ,file=sys.stderr)
-                    self.direction_systems[lang_pair].add(system)
+        self.system_ids = defaultdict(Interner) # indexed by language direction
+        self.segment_ids = defaultdict(Interner) # indexed by language direction
+        self.comparisons_arrays = {} # indexed by language direction
+        self.comparison_indices = {} # indexed by language direction
+        self.metrics_relations = {} # indexed by tuples (metric, direction)
+        self.tau_results = {} # indexed by tuples (metric, direction, variant)
+        self.bootstrap_results = {} # indexed by language direction
+
+    def add_metrics_data(self, *file_likes):
+        columns = [bytes, bytes, None, bytes, np.int64, np.float64]
+        for file, (metrics, lang_pairs, _, systems, segments, scores) in read_files(file_likes, columns, config.jobs):
+            # Lines of the same metric, direction and system are usually together, so the names
+            # are interned once per run of such lines
+            starts = run_starts(metrics, lang_pairs, systems)
+            lengths = np.diff(np.append(starts, len(metrics)))
+            keys = Interner() # of (metric, direction) pairs
+            run_keys = np.empty(len(starts), dtype=np.int64)
+            run_systems = np.empty(len(starts), dtype=np.int64)
+            for run, start in enumerate(starts):
+                lang_pair = lang_pairs[start].decode("utf-8")
+                system = systems[start].decode("utf-8")
+                run_keys[run] = keys.intern((metrics[start].decode("utf-8"), lang_pair))
+                run_systems[run] = self.system_ids[lang_pair].intern(system)
+                self.direction_systems[lang_pair].add(system)
+            row_keys = np.repeat(run_keys, lengths)
+            systems = np.repeat(run_systems, lengths)
+
+            # Scores of the file are collected per metric and direction and stored at once
+            batches = {}
+            for key_id, key in enumerate(keys.names):
+                rows = row_keys == key_id
+                batches[key] = systems[rows], segments[rows], scores[rows]
+
+            for (metric, lang_pair), (systems, segments, scores) in batches.items():
+                if (metric, lang_pair) not in self.metrics_data:
+                    self.metrics_data[metric, lang_pair] = MetricLanguagePairData(self.system_ids[lang_pair], self.segment_ids[lang_pair], config.dtype)
+                segment_ids = self.segment_ids[lang_pair].intern_all(segments)
+                duplicates = self.metrics_data[metric, lang_pair].add(systems, segment_ids, scores)
+                for position in duplicates:
+                    system = self.system_ids[lang_pair].names[systems[position]]
+                    print("Warning: ", metric, lang_pair, system, segments[position], "Segment score already exists." ,file=sys.stderr)
+
+        self.comparisons_arrays.clear()
+        self.metrics_relations.clear()
+        self.tau_results.clear()
+        self.bootstrap_results.clear()
     # def add_human_data(self, file_like):
     #     for file in glob.glob(file_like):
     #         with gzip.open(file, mode="rt") as f:
@@ -215,38 +680,25 @@ class SegmentLevelData(object):
     #                 self.human_comparisons[direction] += extracted_comparisons
 
     def add_human_data(self, file_like):
-        def find_lang(code):
-            langdict = {'cze':'cs', 'eng':'en', 'fre':'fr', 'ces':'cs', 'deu':'de', 'fin':'fi', 'ron':'ro', 'rus':'ru', 'tur':'tr'}
-            if code in langdict:
-                return langdict[code]
-            else:
-                return code
-
         for file in glob.glob(file_like):
-            with gzip.open(file, mode="rt") as f:
+            with gzip_reader.open(file, mode="rt") as f:
                 for line in csv.DictReader(f):
+                    direction, comparison = parse_judgment(line)
+                    if not self.known_systems(direction, comparison):
+                        continue
 
-                    #direction = line['system1Id'].rsplit('.', 2)[1]
-                    direction = find_lang(line['srclang']) + '-' + find_lang(line['trglang'])
-                    segment = int(line['segmentId'])
-
-                    extract_system = lambda x: '.'.join(x.split('.')[1:-1])
+                    self.human_comparisons[direction].append(comparison)
 
+        self.comparisons_arrays.clear()
+        self.comparison_indices.clear()
+        self.metrics_relations.clear()
+        self.tau_results.clear()
+        self.bootstrap_results.clear()
 
-                    id1 = extract_system(line['system1Id'])
-                    rank1 = int(line['system1rank'])
-                    id2 = extract_system(line['system2Id'])
-                    rank2 = int(line['system2rank'])
-                    if id1 not in self.direction_systems[direction] or id2 not in self.direction_systems[direction]:
-                        continue
-                    # Extract all comparisons (Making sure that two systems are extracted only once)
-                    # Also the extracted relation '<' means "is better than"
-                    compare = lambda x, y: '<' if x < y else '>' if x > y else '='
-                    extracted_comparisons = [
-                            (segment, id1, id2, compare(rank1, rank2))
-                        ]
-
-                    self.human_comparisons[direction] += extracted_comparisons
+    def known_systems(self, direction, comparison):
+        """ Tells whether both systems of the comparison have metric scores """
+        segment, id1, id2, human_comparison = comparison
+        return id1 in self.direction_systems[direction] and id2 in self.direction_systems[direction]
 
     def extracted_pairs(self, direction):
         return len(self.human_comparisons[direction])
@@ -256,45 +708,249 @@ class SegmentLevelData(object):
         if (metric,direction) not in self.metrics_data:
             return None, None
 
-        metric_data = self.metrics_data[metric,direction]
-        comparisons = self.human_comparisons[direction]
-        #print(self.human_comparisons[direction])
-        #print(metric, direction, len(metric_data.keys()))
-        #print(self.metrics_data[metric,direction][0])
-        #print(self.metrics_data['ParFDA.4542'])
-        #print(self.metrics_data['online-A.0.'])
-        tau = metric_data.kendall_tau(comparisons, variant)
-
-        confidence = self.compute_confidence(metric_data, comparisons, variant)
+        # Results are kept, so that they can be also saved
+        if (metric, direction, variant) not in self.tau_results:
+            human = self.comparisons_array(direction)[3]
+            relations = self.metric_relations(metric, direction)
+            if relations is None:
+                return None, None
 
-        return tau, confidence
+            tau = kendall_tau(human, relations, variant)
+            if tau is None:
+                tau = 1
 
-    def compute_confidence(self, metric_data, comparisons, variant):
-        if config.bootstrap == 0:
-            return None
+            self.tau_results[metric, direction, variant] = tau, self.bootstrap_taus(direction).get((metric, variant))
 
-        # Setting random seed here, to generate same samples for all metrics and directions
-        random.seed(config.rseed)
+        tau, taus = self.tau_results[metric, direction, variant]
+        return tau, self.compute_confidence(taus)
 
-        taus = []
-        for _ in range(config.bootstrap):
-            sample = (random.choice(comparisons) for _ in comparisons)
-            tau = metric_data.kendall_tau(sample, variant)
-            if tau is None:
-                return None
-            taus.append(tau)
-
-        taus.sort()
+    def bootstrap_taus(self, direction):
+        """ Returns taus of the bootstrap samples (in the order of the samples) of all metrics
+        and variants in the direction, indexed by tuples (metric, variant). The samples are drawn
+        once per direction and all metrics and variants are evaluated on each of them """
+        if config.bootstrap == 0:
+            return {}
+
+        if direction not in self.bootstrap_results:
+            human = self.comparisons_array(direction)[3]
+            metrics_relations = {}
+            for metric in self.metrics():
+                if (metric, direction) in self.metrics_data:
+                    relations = self.metric_relations(metric, direction)
+                    if relations is not None:
+                        metrics_relations[metric] = relations
+            tables = {variant: coefficient_tables(variant) for variant in variants_definitions}
+            taus = {(metric, variant): [] for metric in metrics_relations for variant in tables}
+
+            # Setting random seed here, to generate same samples for all directions
+            random.seed(config.rseed)
+
+            positions = range(len(human))
+            for _ in range(config.bootstrap):
+                sample = np.array([random.choice(positions) for _ in positions], dtype=np.int64)
+                for metric, relations in metrics_relations.items():
+                    counts = contingency_table(human[sample], relations[sample])
+                    for variant, (numerators, denominators) in tables.items():
+                        denominator = (denominators * counts).sum()
+                        taus[metric, variant].append((numerators * counts).sum() / denominator if denominator else 1)
+            self.bootstrap_results[direction] = taus
+
+        return self.bootstrap_results[direction]
+
+    def confidence_interval(self, taus):
+        if taus is None:
+            return None, None
 
-        avg_tau = sum(taus) / len(taus)
+        taus = sorted(taus)
 
         l_tau = taus[int(config.bootstrap * alpha/2)]
         r_tau = taus[int(config.bootstrap * (1 - alpha/2))]
+        return l_tau, r_tau
+
+    def compute_confidence(self, taus):
+        if taus is None:
+            return None
+
+        l_tau, r_tau = self.confidence_interval(taus)
         return abs(l_tau - r_tau) / 2
 
+    def fingerprint(self, directions):
+        """ Returns a hash of the human comparisons of given directions and of the bootstrap settings,
+        runs with the same fingerprint have the same bootstrap samples """
+        settings = "%s %s" % (config.bootstrap, config.rseed) if config.bootstrap else "0"
+        digest = hashlib.sha1(settings.encode("utf-8"))
+        for direction in sorted(directions):
+            digest.update(direction.encode("utf-8") + b'\0')
+            # The order of the comparisons is kept, the bootstrap samples depend on it
+            text = "".join("%d\t%s\t%s\t%s\n" % comparison for comparison in self.human_comparisons[direction])
+            digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def comparison_index(self, direction):
+        if direction not in self.comparison_indices:
+            self.comparison_indices[direction] = ComparisonIndex(self.human_comparisons[direction])
+        return self.comparison_indices[direction]
+
+    def comparisons_array(self, direction):
+        """ Returns the human comparisons of the direction as arrays of segment ids, ids of
+        the first and the second system and relation codes of the comparison """
+        if direction not in self.comparisons_arrays:
+            comparisons = self.human_comparisons[direction]
+            system_ids = self.system_ids[direction]
+            segment_ids = self.segment_ids[direction]
+            self.comparisons_arrays[direction] = (
+                    np.fromiter((segment_ids.get(comparison[0], -1) for comparison in comparisons), dtype=np.int64, count=len(comparisons)),
+                    np.fromiter((system_ids.get(comparison[1], -1) for comparison in comparisons), dtype=np.int64, count=len(comparisons)),
+                    np.fromiter((system_ids.get(comparison[2], -1) for comparison in comparisons), dtype=np.int64, count=len(comparisons)),
+                    np.fromiter((relation_codes[comparison[3]] for comparison in comparisons), dtype=np.int8, count=len(comparisons)),
+                )
+        return self.comparisons_arrays[direction]
+
+    def metric_relations(self, metric, direction):
+        if (metric, direction) not in self.metrics_relations:
+            segments, systems1, systems2, human = self.comparisons_array(direction)
+            self.metrics_relations[metric, direction] = self.metrics_data[metric, direction].relations(systems1, systems2, segments)
+        return self.metrics_relations[metric, direction]
+
+    def compute_slice(self, metrics, direction, variant, positions):
+        """ Computes Kendall's tau, pairwise accuracy and tau confidence of the metrics on the subset
+        of human comparisons at given positions (see ComparisonIndex.select). Returns a dictionary
+        of (tau, accuracy, confidence) indexed by metric. The bootstrap samples of the subset are
+        drawn once and all metrics are evaluated on them """
+        positions = np.asarray(positions, dtype=np.int64)
+        human = self.comparisons_array(direction)[3][positions]
+
+        metrics_relations = {}
+        for metric in metrics:
+            if (metric, direction) in self.metrics_data:
+                relations = self.metric_relations(metric, direction)
+                if relations is not None:
+                    metrics_relations[metric] = relations[positions]
+
+        taus = dict((metric, None) for metric in metrics_relations)
+        if config.bootstrap != 0 and len(positions):
+            numerators, denominators = coefficient_tables(variant)
+            # Indicators of the pairs of human and metric relation codes of each comparison,
+            # so that the contingency tables of all samples are products with the sample counts
+            indicators = dict(
+                    (metric, np.eye(9)[human.astype(np.int64) * 3 + relations])
+                    for metric, relations in metrics_relations.items()
+                )
+            tables = dict((metric, []) for metric in metrics_relations)
+            rng = np.random.default_rng(config.rseed)
+            # Samples are generated in blocks to bound the memory
+            block = max(1, min(config.bootstrap, 10**7 // len(positions)))
+            for start in range(0, config.bootstrap, block):
+                weights = bootstrap_weights(rng, len(positions), min(block, config.bootstrap - start))
+                for metric in metrics_relations:
+                    tables[metric].append(weights @ indicators[metric])
+
+            for metric in metrics_relations:
+                metric_tables = np.concatenate(tables[metric])
+                sample_denominators = metric_tables @ denominators.ravel()
+                # A sample without any counted comparison has no tau
+                if (sample_denominators > 0).all():
+                    taus[metric] = list(metric_tables @ numerators.ravel() / sample_denominators)
+
+        results = dict((metric, (None, None, None)) for metric in metrics)
+        for metric, relations in metrics_relations.items():
+            results[metric] = (
+                    kendall_tau(human, relations, variant),
+                    pairwise_accuracy(human, relations),
+                    self.compute_confidence(taus[metric]),
+                )
+        return results
+
+    def tau_coefficients(self, metrics, direction, variant):
+        """ Returns the contributions of each human comparison to the numerator of Kendall's tau
+        of each metric (a comparisons x metrics matrix) and to the denominator (a vector, it does
+        not depend on the metric). Metrics with missing segment scores are left out, the list of
+        used metrics is returned as well """
+        numerators, denominators = coefficient_tables(variant)
+        human = self.comparisons_array(direction)[3]
+
+        used_metrics = []
+        columns = []
+        for metric in metrics:
+            if (metric, direction) not in self.metrics_data:
+                continue
+            relations = self.metric_relations(metric, direction)
+            if relations is None:
+                continue
+            used_metrics.append(metric)
+            columns.append(relations)
+
+        if not columns:
+            return used_metrics, np.zeros((len(human), 0)), np.zeros(len(human))
+
+        metric_relations = np.stack(columns, axis=1)
+        # The denominator coefficients of a human comparison are the same for all metric comparisons
+        return used_metrics, numerators[human[:, None], metric_relations], denominators[human, 0]
+
     def metrics(self):
         return list(set(pair[0] for pair in self.metrics_data.keys()))
 
+def paired_significance(numerators, denominators, method, replicates, seed):
+    """ Paired significance test of the differences of Kendall's tau between all pairs of metrics.
+    All metrics are evaluated on the same resampled (or permuted) human comparisons. Returns the
+    taus and a metrics x metrics matrix of p-values of the row metric not being better than the column metric.
+
+    bootstrap: p-value is the fraction of bootstrap samples where the row metric's tau is lower than
+    or equal to the column metric's tau.
+    permutation: the metric scores of the two metrics are randomly swapped for each human comparison,
+    p-value is the fraction of permutations with difference of taus at least as high as observed.
+    """
+    rng = np.random.default_rng(seed)
+    count, n_metrics = numerators.shape
+    total = denominators.sum()
+    taus = numerators.sum(axis=0) / total
+    observed = taus[:, None] - taus[None, :]
+    hits = np.zeros((n_metrics, n_metrics))
+
+    # Replicates are generated in blocks to bound the memory
+    block = max(1, min(replicates, 10**7 // max(count, 1)))
+    for start in range(0, replicates, block):
+        size = min(block, replicates - start)
+
+        if method == "bootstrap":
+            weights = bootstrap_weights(rng, count, size)
+            sample_taus = (weights @ numerators) / (weights @ denominators)[:, None]
+            hits += (sample_taus[:, :, None] <= sample_taus[:, None, :]).sum(axis=0)
+
+        elif method == "permutation":
+            # Swapping the two metrics flips the sign of their difference on the comparison,
+            # the difference of taus is linear so the products are only computed per metric
+            signs = rng.integers(0, 2, size=(size, count)) * 2.0 - 1
+            permuted = (signs @ numerators) / total
+            hits += (permuted[:, :, None] - permuted[:, None, :] >= observed[None, :, :]).sum(axis=0)
+
+        else:
+            raise ValueError("Unknown significance test %s" % method)
+
+    if method == "bootstrap":
+        p_values = hits / replicates
+    else:
+        p_values = (hits + 1) / (replicates + 1)
+    np.fill_diagonal(p_values, np.nan)
+    return taus, p_values
+
+def bootstrap_weights(rng, count, size):
+    """ Returns size x count matrix with the number of times each of count items is drawn
+    into each of size bootstrap samples """
+    samples = rng.integers(0, count, size=(size, count)) + count * np.arange(size)[:, None]
+    return np.bincount(samples.ravel(), minlength=size * count).reshape(size, count).astype(float)
+
+def contingency_table(human, relations):
+    """ Returns 3x3 table with counts of the pairs of human and metric relation codes """
+    return np.bincount(human.astype(np.int64) * 3 + relations, minlength=9).reshape(3, 3)
+
+def pairwise_accuracy(human, relations):
+    """ Fraction of the non-tied human comparisons the metric agrees with """
+    not_tied = human != relation_codes['=']
+    if not not_tied.any():
+        return None
+    return (relations[not_tied] == human[not_tied]).mean()
+
 class ResultTable(object):
     def __init__(self, data, directions):
         self.directions = directions
@@ -330,6 +986,191 @@ class ResultTable(object):
             numalign='left',
         )
 
+class SignificanceTable(object):
+    """ Matrix of p-values of paired significance tests between all metrics in one language direction """
+
+    def __init__(self, data, direction, variant, method, replicates):
+        metrics, numerators, denominators = data.tau_coefficients(sorted(data.metrics()), direction, variant)
+        taus, p_values = paired_significance(numerators, denominators, method, replicates, config.rseed)
+
+        # Best metrics first
+        order = sorted(range(len(metrics)), key=lambda idx: -taus[idx])
+        self.metrics = [metrics[idx] for idx in order]
+        self.rows = [
+                [metrics[row], taus[row]] + [None if row == col else "%.3f" % p_values[row, col] for col in order]
+                for row in order
+            ]
+
+    def header(self):
+        header_list = ["Metric", "Tau"] + self.metrics
+        if config.tablefmt == "latex":
+            return ["\\textbf{%s}" % header for header in header_list]
+        else:
+            return header_list
+
+    def tabulate(self):
+        return tabulate(
+            self.rows,
+            headers=self.header(),
+            tablefmt=config.tablefmt,
+            floatfmt='.3f',
+            missingval='-',
+            numalign='left',
+        )
+
+class StreamingTaus(object):
+    """ Running Kendall's taus of all metrics while new human comparisons arrive. For each metric
+    and direction only the contingency table of human and metric relations is kept, all variants
+    are computed from it, so a batch of comparisons is added in time proportional to its size.
+    """
+
+    def __init__(self, data, directions, new_directions=False):
+        self.data = data
+        self.directions = []
+        self.new_directions = new_directions
+        self.metrics = sorted(data.metrics())
+        self.pairs = defaultdict(int) # indexed by language direction
+        self.counts = {} # indexed by tuples (metric, direction), None if some score is missing
+
+        for direction in directions:
+            self.add_direction(direction)
+
+    def add_direction(self, direction):
+        segments, systems1, systems2, human = self.data.comparisons_array(direction)
+        self.directions.append(direction)
+        self.pairs[direction] = len(human)
+        for metric in self.metrics:
+            if (metric, direction) not in self.data.metrics_data:
+                continue
+            relations = self.data.metric_relations(metric, direction)
+            self.counts[metric, direction] = None if relations is None else contingency_table(human, relations)
+
+    def add_lines(self, lines):
+        """ Adds human judgments given as CSV lines, header lines are skipped """
+        batches = defaultdict(list)
+        for line in csv.DictReader(lines, fieldnames=judgment_fields):
+            if line['srclang'] == judgment_fields[0]:
+                continue
+            direction, comparison = parse_judgment(line)
+            if direction not in self.directions and self.new_directions and direction in self.data.direction_systems:
+                self.add_direction(direction)
+            if direction in self.directions and self.data.known_systems(direction, comparison):
+                batches[direction].append(comparison)
+
+        for direction, comparisons in batches.items():
+            self.add_comparisons(direction, comparisons)
+
+    def add_comparisons(self, direction, comparisons):
+        system_ids = self.data.system_ids[direction]
+        segment_ids = self.data.segment_ids[direction]
+        segments = np.array([segment_ids.get(comparison[0], -1) for comparison in comparisons], dtype=np.int64)
+        systems1 = np.array([system_ids.get(comparison[1], -1) for comparison in comparisons], dtype=np.int64)
+        systems2 = np.array([system_ids.get(comparison[2], -1) for comparison in comparisons], dtype=np.int64)
+        human = np.array([relation_codes[comparison[3]] for comparison in comparisons], dtype=np.int8)
+        self.pairs[direction] += len(comparisons)
+
+        for metric in self.metrics:
+            if self.counts.get((metric, direction)) is None:
+                continue
+            relations = self.data.metrics_data[metric, direction].relations(systems1, systems2, segments)
+            if relations is None:
+                self.counts[metric, direction] = None
+            else:
+                self.counts[metric, direction] += contingency_table(human, relations)
+
+    def tau_confidence(self, metric, direction, variant):
+        """ Returns Kendall's tau and the half width of its approximate confidence interval """
+        counts = self.counts.get((metric, direction))
+        if counts is None:
+            return None, None
+
+        numerators, denominators = coefficient_tables(variant)
+        denominator = (counts * denominators).sum()
+        if denominator == 0:
+            return 1, None
+        numerator = (counts * numerators).sum()
+        squares = (counts * numerators * numerators).sum()
+
+        # Variance of the ratio estimate (delta method), the comparisons are the observations
+        tau = numerator / denominator
+        variance = (squares - 2 * tau * numerator + tau * tau * denominator) / (denominator * denominator)
+        z = NormalDist().inv_cdf(1 - alpha/2)
+        return tau, z * math.sqrt(max(variance, 0))
+
+    def status(self):
+        return ", ".join("%s: %d pairs" % (direction, self.pairs[direction]) for direction in self.directions)
+
+class StreamingTable(object):
+    """ Table with current Kendall's taus of all metrics in all directions and variants """
+
+    def __init__(self, streaming):
+        self.directions = streaming.directions
+        self.variants = [config.variant] + sorted(set(variants_definitions.keys()) - set([config.variant]))
+        self.rows = []
+        for metric in streaming.metrics:
+            row = [metric]
+            for direction in self.directions:
+                for variant in self.variants:
+                    tau, confidence = streaming.tau_confidence(metric, direction, variant)
+                    row.append(format_result(tau, confidence))
+            self.rows.append(row)
+
+    def header(self):
+        header_list = ["Metric"] + [direction + ' (' + variant + ')' for direction in self.directions for variant in self.variants]
+        if config.tablefmt == "latex":
+            return ["\\textbf{%s}" % header for header in header_list]
+        else:
+            return header_list
+
+    def tabulate(self):
+        return tabulate(
+            self.rows,
+            headers=self.header(),
+            tablefmt=config.tablefmt,
+            floatfmt='.3f',
+            missingval='n/a',
+            numalign='left',
+        )
+
+class SliceTable(object):
+    """ Table with Kendall's tau and pairwise accuracy of every metric for each
+    subset (slice) of the human comparisons of one language direction """
+
+    def __init__(self, data, direction, variant, slices):
+        self.variant = variant
+        self.metrics = sorted(data.metrics())
+        index = data.comparison_index(direction)
+
+        self.rows = []
+        for name, segments, system_pairs in slices:
+            positions = index.select(segments, system_pairs)
+            results = data.compute_slice(self.metrics, direction, variant, positions)
+            row = [name, len(positions)]
+            for metric in self.metrics:
+                tau, accuracy, confidence = results[metric]
+                row.append(format_result(tau, confidence))
+                row.append(format_result(accuracy, None))
+            self.rows.append(row)
+
+    def header(self):
+        header_list = ["Slice", "Pairs"]
+        for metric in self.metrics:
+            header_list += [metric + ' (' + self.variant + ')', metric + ' (accuracy)']
+        if config.tablefmt == "latex":
+            return ["\\textbf{%s}" % header for header in header_list]
+        else:
+            return header_list
+
+    def tabulate(self):
+        return tabulate(
+            self.rows,
+            headers=self.header(),
+            tablefmt=config.tablefmt,
+            floatfmt='.3f',
+            missingval='n/a',
+            numalign='left',
+        )
+
 class ResultRow(object):
     def __init__(self, data, metric, directions, variant, other_variants):
         self.metric = metric
@@ -402,6 +1243,15 @@ class ResultRow(object):
     def __bool__(self):
         return not all([result is None for result in self.results])
 
+def format_result(result, confidence):
+    if result is None:
+        return None
+    if confidence is None:
+        return "%.3f" % result
+    if config.tablefmt == "latex":
+        return "$%.3f \\pm %.3f$" % (result, confidence)
+    return "%.3f±%.3f" % (result, confidence)
+
 def safe_avg(iterable):
     filtered = list(filter(None, iterable))
     try:
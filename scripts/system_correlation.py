@@ -5,15 +5,15 @@
 from textwrap import dedent
 from scipy.stats import spearmanr
 from scipy.stats import pearsonr
+from scipy.stats import rankdata
 from collections import defaultdict
-import gzip
-import csv
+import numpy as np
 import argparse
 import sys
-import glob
-import math
 import os
+import hashlib
 from tabulate import tabulate
+from common import read_files, Interner, write_results, positive_int
 
 alpha = 0.05
 
@@ -58,6 +58,21 @@ def parse_args():
             choices=["plain","simple","grid","pipe","orgtbl","rst","mediawiki","latex"]
             )
 
+    parser.add_argument("--jobs",
+            help="Number of files decompressed in parallel (default is the number of CPUs)",
+            metavar="N",
+            default=os.cpu_count() or 1,
+            type=positive_int,
+            )
+
+    parser.add_argument("--save-results",
+            help="Store the correlations, confidence intervals and correlations with all samples"
+                 " to SQLite database FILE (runs are compared by compare_results.py)",
+            metavar="FILE",
+            default=None,
+            dest='results_file',
+            )
+
     parser.add_argument("--plot-scores",
             help="Plot human and metric's scores for each metric and direction to specified directory",
             metavar="OUT_DIR",
@@ -72,8 +87,7 @@ config = parse_args()
 def main():
     # Load data
     data = SystemLevelMetricsData()
-    for file in config.metrics:
-        data.add_metrics_data(file)
+    data.add_metrics_data(*config.metrics)
     data.add_human_data(config.human)
     for filename in config.samples:
     	data.add_sample_data(filename)
@@ -86,32 +100,90 @@ def main():
     # Print results
     print(result_table.tabulate())
 
+    if config.results_file:
+        save_results(data, config.directions, config.results_file)
+
 class KeyAlreadySetException(Exception): pass
-class NumberOfFieldsNotExpectedException(Exception): pass
 
-class MetricLanguagePairData(dict):
+class MetricLanguagePairData(object):
     """ Dictionary like object which for a given metric and a given language direction
     stores all systems' scores. The keys are systems and values are metric's scores.
+    The scores are kept in an array indexed by system ids of an interner shared by
+    all metrics of the direction, a bitmap marks the scores present.
     """
 
+    def __init__(self, system_ids, dtype=np.float64):
+        self.system_ids = system_ids
+        self.scores = np.zeros(0, dtype=dtype)
+        self.present = np.zeros(0, dtype=np.uint8) # one bit per system
+
+    def is_present(self, system_id):
+        return system_id >> 3 < len(self.present) and self.present[system_id >> 3] >> (system_id & 7) & 1 == 1
+
+    def ids(self):
+        """ Returns array of ids of the systems with a score """
+        present = np.unpackbits(self.present, bitorder='little')[:len(self.scores)]
+        return np.flatnonzero(present)
+
     def __setitem__(self, key, val):
         """This method overrides classic dictionary element assignment.
         It's only function is to checks that no system score is assigned twice.
         """
-        if key in self:
+        system_id = self.system_ids.intern(key)
+        if self.is_present(system_id):
             raise KeyAlreadySetException("The system %s score is already in the data" % key)
-        dict.__setitem__(self, key, val)
+        if system_id >= len(self.scores):
+            size = max(system_id + 1, 2 * len(self.scores))
+            self.scores = np.concatenate([self.scores, np.zeros(size - len(self.scores), dtype=self.scores.dtype)])
+            self.present = np.concatenate([self.present, np.zeros((size + 7) // 8 - len(self.present), dtype=np.uint8)])
+        self.scores[system_id] = val
+        self.present[system_id >> 3] |= 1 << (system_id & 7)
+
+    def __getitem__(self, key):
+        system_id = self.system_ids.get(key, -1)
+        if system_id < 0 or not self.is_present(system_id):
+            raise KeyError(key)
+        return self.scores[system_id].item()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        system_id = self.system_ids.get(key, -1)
+        return system_id >= 0 and self.is_present(system_id)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.ids())
+
+    def keys(self):
+        return [self.system_ids.names[system_id] for system_id in self.ids()]
+
+    def fingerprint(self):
+        """ Returns a hash of the stored (system name, score) pairs in the order of names """
+        ids = sorted(self.ids(), key=lambda system_id: self.system_ids.names[system_id])
+        digest = hashlib.sha1()
+        digest.update("\t".join(self.system_ids.names[system_id] for system_id in ids).encode("utf-8"))
+        digest.update(self.scores[ids].astype(np.float64).tobytes())
+        return digest.hexdigest()
 
     def correlation(self, other, corr_type):
         """Computes the spearman or pearson correlation of metric scores and
         given human scores """
 
-        set1 = set(self)
-        set2 = set(other)
-        intersection = set1 & set2
+        ids1 = self.ids()
+        ids2 = other.ids()
+        intersection = np.intersect1d(ids1, ids2)
 
         # Checks that the sets of used systems are equal
-        if set1 != set2:
+        if len(intersection) != len(ids1) or len(intersection) != len(ids2):
+            set1 = set(self)
+            set2 = set(other)
             print(dedent("""\
                     The sets of system are not equal:
                     missing human: %s
@@ -120,12 +192,11 @@ class MetricLanguagePairData(dict):
                     """) % (
                         ", ".join(sorted(set1 - set2)),
                         ", ".join(sorted(set2 - set1)),
-                        ", ".join(sorted(intersection))
+                        ", ".join(sorted(set1 & set2))
                         ), file=sys.stderr)
 
-        systems_fixed_order = list(intersection)
-        scores1 = list(map(self.get, systems_fixed_order))
-        scores2 = list(map(other.get, systems_fixed_order))
+        scores1 = self.scores[intersection]
+        scores2 = other.scores[intersection]
 
         if corr_type == "pearson":
             corr_func = pearsonr
@@ -138,42 +209,44 @@ class MetricLanguagePairData(dict):
 class MetricData(defaultdict):
     """Dictionary like object which for a given metric stores all systems' scores for
     all language direction. The keys are language directions and values are objects
-    of MetricLanguagePairData class
+    of MetricLanguagePairData class sharing the system ids of the direction
     """
-    def __init__(self):
-        defaultdict.__init__(self, MetricLanguagePairData)
+    def __init__(self, system_ids):
+        defaultdict.__init__(self)
+        self.system_ids = system_ids
+
+    def __missing__(self, direction):
+        self[direction] = MetricLanguagePairData(self.system_ids[direction])
+        return self[direction]
 
 class SystemLevelMetricsData(object):
     """ Stores scores for all metrics, language directions and systems. Also stores human scores
     for all language direction and systems.
     """
     def __init__(self):
-        self.metrics_data = defaultdict(MetricData)
+        self.system_ids = defaultdict(Interner) # indexed by language direction
+        self.metrics_data = {}
         self.sample_data_list = []
         self.directions = set()
-
-    def iter_records(self, file_like):
-        for file in glob.glob(file_like):
-            with gzip.open(file, mode="rt") as f:
-                for line in csv.reader(f, delimiter='\t'):
-                    if len(line) != 5:
-                        raise NumberOfFieldsNotExpectedException("Got %s fields in file %s" % (len(line), file))
-
-                    metric    = line[0]
-                    lang_pair = line[1]
-                    test_set  = line[2]
-                    system    = line[3]
-                    score     = float(line[4])
-
-                    yield metric, lang_pair, system, score
-
-
-    def add_metrics_data(self, file):
-        for metric, lang_pair, system, score in self.iter_records(file):
+        self.samples_correlations = {} # indexed by language direction
+        self.samples_intervals = {} # indexed by language direction
+
+    def iter_records(self, *file_likes):
+        columns = [bytes, bytes, None, bytes, np.float64]
+        for file, (metrics, lang_pairs, _, systems, scores) in read_files(file_likes, columns, config.jobs):
+            names = [np.char.decode(column, "utf-8").tolist() for column in (metrics, lang_pairs, systems)]
+            yield from zip(*names, scores.tolist())
+
+    def add_metrics_data(self, *files):
+        for metric, lang_pair, system, score in self.iter_records(*files):
+            if metric not in self.metrics_data:
+                self.metrics_data[metric] = MetricData(self.system_ids)
             self.metrics_data[metric][lang_pair][system] = score
+        self.samples_correlations.clear()
+        self.samples_intervals.clear()
 
     def load_human_data(self, file):
-        data = MetricData()
+        data = MetricData(self.system_ids)
         for metric, lang_pair, system, score in self.iter_records(file):
             data[lang_pair][system] = score
             self.directions.add(lang_pair)
@@ -184,6 +257,8 @@ class SystemLevelMetricsData(object):
 
     def add_sample_data(self, file):
         self.sample_data_list.append(self.load_human_data(file))
+        self.samples_correlations.clear()
+        self.samples_intervals.clear()
 
     def metrics(self):
         return self.metrics_data.keys()
@@ -212,22 +287,85 @@ class SystemLevelMetricsData(object):
         if not self.sample_data_list:
             return None
 
-        metric_scores = self.metrics_data[metric][direction]
-
-        corrs = []
-        for human_data in self.sample_data_list:
-            human_scores = human_data[direction]
-            corr = metric_scores.correlation(human_scores, corr_type)
-            corrs.append(corr)
-
-        avg_corr = sum(corrs) / len(corrs)
-
-        corrs.sort()
-
-        l_corr = corrs[int(len(corrs) * alpha/2)]
-        r_corr = corrs[int(len(corrs) * (1 - alpha/2))]
+        l_corr, r_corr = self.confidence_intervals(direction)[corr_type][metric]
         return abs(l_corr - r_corr) / 2
 
+    def sample_correlations(self, direction):
+        """ Computes the pearson and spearman correlations of all metrics with all samples of
+        human scores at once. Returns the list of metrics and a dictionary mapping correlation type
+        to a samples x metrics matrix of correlations """
+        if direction in self.samples_correlations:
+            return self.samples_correlations[direction]
+
+        # Align the samples and the metrics into matrices with a column for each system
+        size = len(self.system_ids[direction].names)
+        samples = np.full((len(self.sample_data_list), size), np.nan)
+        for row, human_data in enumerate(self.sample_data_list):
+            scores = human_data[direction]
+            ids = scores.ids()
+            samples[row, ids] = scores.scores[ids]
+
+        metrics = list(self.metrics())
+        metrics_scores = np.full((len(metrics), size), np.nan)
+        for row, metric in enumerate(metrics):
+            if direction in self.metrics_data[metric]:
+                scores = self.metrics_data[metric][direction]
+                ids = scores.ids()
+                metrics_scores[row, ids] = scores.scores[ids]
+
+        corrs = {
+                "pearson": np.full((len(samples), len(metrics)), np.nan),
+                "spearman": np.full((len(samples), len(metrics)), np.nan),
+            }
+        # Samples and metrics with scores of the same systems are processed together,
+        # the correlations are computed on the intersection of their systems
+        for samples_columns, samples_rows in group_rows(~np.isnan(samples)):
+            for metrics_columns, metrics_rows in group_rows(~np.isnan(metrics_scores)):
+                columns = samples_columns & metrics_columns
+                if columns.sum() < 2:
+                    continue
+                human = samples[np.ix_(samples_rows, columns)]
+                metric = metrics_scores[np.ix_(metrics_rows, columns)]
+                block = np.ix_(samples_rows, metrics_rows)
+                corrs["pearson"][block] = row_correlations(human, metric)
+                corrs["spearman"][block] = row_correlations(rankdata(human, axis=1), rankdata(metric, axis=1))
+
+        self.samples_correlations[direction] = metrics, corrs
+        return self.samples_correlations[direction]
+
+    def confidence_intervals(self, direction):
+        """ Returns dictionary mapping correlation type to dictionary mapping metric to the
+        (lower, upper) bounds of its confidence interval estimated from the samples """
+        if direction in self.samples_intervals:
+            return self.samples_intervals[direction]
+
+        metrics, corrs = self.sample_correlations(direction)
+
+        count = len(self.sample_data_list)
+        l_idx = int(count * alpha/2)
+        r_idx = min(int(count * (1 - alpha/2)), count - 1)
+
+        intervals = {}
+        for corr_type, matrix in corrs.items():
+            # Only the two order statistics are needed, no need to sort all correlations
+            bounds = np.partition(matrix, sorted(set([l_idx, r_idx])), axis=0)
+            intervals[corr_type] = {
+                    metric: (bounds[l_idx, col].item(), bounds[r_idx, col].item())
+                    for col, metric in enumerate(metrics)
+                }
+        self.samples_intervals[direction] = intervals
+        return self.samples_intervals[direction]
+
+    def fingerprint(self, directions):
+        """ Returns a hash of the human scores and the samples in given directions,
+        runs with the same fingerprint have the same samples """
+        digest = hashlib.sha1()
+        for direction in sorted(directions):
+            digest.update(direction.encode("utf-8"))
+            for human_data in [self.human_data] + self.sample_data_list:
+                digest.update(human_data[direction].fingerprint().encode("utf-8"))
+        return digest.hexdigest()
+
     def plot_scores(self, metric_scores, human_scores, metric, direction):
 
         fig_format = "png"
@@ -366,6 +504,48 @@ class ResultRow(object):
     def __bool__(self):
         return not all([x is None for x in self.results])
 
+def save_results(data, directions, file):
+    """ Stores results of all metrics, directions and correlation types to SQLite database """
+    rows = []
+    for metric in sorted(data.metrics()):
+        for direction in directions:
+            if direction not in data.metrics_data[metric]:
+                continue
+            metric_scores = data.metrics_data[metric][direction]
+            fingerprint = metric_scores.fingerprint()
+            for corr_type in ["pearson", "spearman"]:
+                corr = metric_scores.correlation(data.human_data[direction], corr_type)
+                lower, upper, samples = None, None, None
+                if data.sample_data_list:
+                    lower, upper = data.confidence_intervals(direction)[corr_type][metric]
+                    metrics, corrs = data.sample_correlations(direction)
+                    samples = corrs[corr_type][:, metrics.index(metric)].astype(np.float64).tobytes()
+                rows.append((metric, direction, corr_type, float(corr), lower, upper, fingerprint, samples))
+
+    info = {
+            "level": "system",
+            "human": data.fingerprint(directions),
+            "bootstrap": str(len(data.sample_data_list)),
+        }
+    write_results(file, info, rows)
+
+def group_rows(mask):
+    """ Yields each distinct row of boolean matrix together with the indices of the rows equal to it """
+    if len(mask) == 0:
+        return
+    unique, inverse = np.unique(mask, axis=0, return_inverse=True)
+    for idx, row in enumerate(unique):
+        yield row, np.flatnonzero(inverse.ravel() == idx)
+
+def row_correlations(x, y):
+    """ Returns matrix of pearson correlations of each row of x with each row of y """
+    x = x - x.mean(axis=1, keepdims=True)
+    y = y - y.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = x / np.sqrt((x * x).sum(axis=1, keepdims=True))
+        y = y / np.sqrt((y * y).sum(axis=1, keepdims=True))
+    return np.clip(x @ y.T, -1, 1)
+
 def safe_max(iterable):
     maximum = None
     for item in filter(None, iterable):